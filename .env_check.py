@@ -1,9 +1,12 @@
-﻿import sys, importlib
+﻿import sys
+from importlib.util import find_spec
 print('Python:', sys.executable)
-mods = ['streamlit','pandas','dateutil','plotly.express','requests','wikipedia','fuzzywuzzy']
+mods = ['streamlit','pandas','pyarrow','plotly.express','requests','rapidfuzz']
 for m in mods:
+    # find_spec only locates the module; it doesn't run its (slow) top-level code
     try:
-        importlib.import_module(m)
-        print('OK:', m)
+        found = find_spec(m) is not None
     except Exception as e:
         print('FAIL:', m, '->', e)
+        continue
+    print('OK:' if found else 'FAIL:', m)
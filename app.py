@@ -1,13 +1,22 @@
 from __future__ import annotations
+import io
 import streamlit as st
 import pandas as pd
-from dateutil import parser
 from pathlib import Path
 import plotly.express as px
+from concurrent.futures import ThreadPoolExecutor
 from categorize import MerchantCategorizer, DEFAULT_CATEGORIES, OnlineGuesser
 
 st.set_page_config(page_title="SpendWise", page_icon="💸", layout="wide")
 
+COLUMN_CONFIG = {
+    "date": st.column_config.DateColumn("Date"),
+    "amount": st.column_config.NumberColumn("Amount", help="Positive = spend; negative = refund"),
+    "is_shared": st.column_config.CheckboxColumn("Shared?"),
+    "your_share": st.column_config.NumberColumn("Your share", help="Portion that applies to you"),
+}
+PIE_KW = dict(names="category", values="your_share", title="Your share by category")
+
 st.title("SpendWise 💸 – Upload, Categorize, Analyze")
 st.caption("Auto-categorize merchants (online + saved map), ask only when unsure, track shared expenses, and see totals.")
 
@@ -15,10 +24,27 @@ with st.sidebar:
     st.header("Settings")
     map_path = st.text_input("Merchant map file", value="data/merchant_map.csv")
     enable_online = st.checkbox("Enable online auto-categorization (OSM + Wikipedia)", value=True)
+    date_format = st.text_input("Date format (optional)", value="", help="e.g. %d/%m/%Y. Leave blank to auto-detect.")
     st.write("Online hints are best-effort; your saved map always wins.")
 
-cat = MerchantCategorizer(Path(map_path))
-web = OnlineGuesser()
+@st.cache_resource(max_entries=4)
+def get_categorizer(map_path: str, mtime_ns: int | None) -> MerchantCategorizer:
+    # mtime_ns is only part of the cache key: hand edits to the map file trigger a reload
+    return MerchantCategorizer(Path(map_path))
+
+@st.cache_resource
+def get_guesser() -> OnlineGuesser:
+    return OnlineGuesser()
+
+map_file = Path(map_path)
+cat = get_categorizer(map_path, map_file.stat().st_mtime_ns if map_file.exists() else None)
+web = get_guesser()
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_by_cat_and_fig(df: pd.DataFrame):
+    by_cat = df.groupby("category", observed=True, as_index=False)["your_share"].sum().sort_values("your_share", ascending=False)
+    fig = px.pie(by_cat, **PIE_KW)
+    return by_cat, fig
 
 uploaded = st.file_uploader("Upload your statement CSV", type=["csv"])
 
@@ -34,15 +60,35 @@ with col4:
     st.checkbox("Treat all as not shared by default", value=True, key="shared_default")  # placeholder
 
 if uploaded is not None:
-    df_raw = pd.read_csv(uploaded)
+    try:
+        df_raw = pd.read_csv(uploaded, engine="pyarrow", dtype_backend="pyarrow")
+    except pd.errors.ParserError:
+        # pyarrow rejects ragged rows (e.g. a "Total,..." trailer); the C engine pads them and dropna cleans up
+        uploaded.seek(0)
+        try:
+            df_raw = pd.read_csv(uploaded, dtype_backend="pyarrow")
+        except pd.errors.ParserError as e:
+            st.error(f"Could not read the CSV: {e}")
+            st.stop()
     for c in [date_col, desc_col, amt_col]:
         if c not in df_raw.columns:
             st.error(f"Missing column: {c}. Please fix names above.")
             st.stop()
 
+    try:
+        dates = pd.to_datetime(df_raw[date_col], errors="coerce", format=date_format or "mixed", dayfirst=False)
+    except ValueError as e:
+        # errors="coerce" covers bad values, not a malformed format string
+        st.error(f"Invalid date format {date_format!r}: {e}. Please fix it in the sidebar.")
+        st.stop()
+    bad_dates = int((dates.isna() & df_raw[date_col].notna()).sum())
+    if bad_dates:
+        st.warning(f"{bad_dates} row(s) have a date that couldn't be parsed and were skipped. "
+                   "Try setting a date format in the sidebar.")
+
     df = pd.DataFrame({
-        "date": pd.to_datetime(df_raw[date_col].apply(lambda x: parser.parse(str(x), dayfirst=False, fuzzy=True)), errors="coerce"),
-        "merchant": df_raw[desc_col].astype(str).str.strip(),
+        "date": dates,
+        "merchant": df_raw[desc_col].astype("string[pyarrow]").str.strip(),
         "amount": pd.to_numeric(df_raw[amt_col], errors="coerce"),
     }).dropna(subset=["date", "merchant", "amount"])
 
@@ -51,14 +97,23 @@ if uploaded is not None:
         df["amount"] = -df["amount"]
 
     # 1) Use saved map first
-    df["category"] = df["merchant"].apply(lambda m: cat.get_category(m))
+    df["_norm"] = df["merchant"].str.upper()  # already stripped above
+    norms = df["_norm"].unique().tolist()
+    df["category"] = df["_norm"].map(dict(zip(norms, cat.categorize_many(norms))))
 
     # 2) For still-unknown, try online guesser
     if enable_online:
         unknown_idx = df["category"].isna()
         if unknown_idx.any():
-            guesses = df.loc[unknown_idx, "merchant"].apply(lambda m: web.guess(m))
-            df.loc[unknown_idx, "category"] = guesses
+            unknowns = df.loc[unknown_idx, "merchant"].unique().tolist()
+            # The cached guesser memoizes across reruns; only names it hasn't resolved go to the pool
+            misses = [m for m in unknowns if not web.is_cached(m)]
+            fetched = {}
+            if misses:
+                with ThreadPoolExecutor(max_workers=8) as ex:
+                    fetched = dict(zip(misses, ex.map(web.guess, misses)))
+            guesses = {m: fetched[m] if m in fetched else web.guess(m) for m in unknowns}
+            df.loc[unknown_idx, "category"] = df.loc[unknown_idx, "merchant"].map(guesses)
 
     # Ask you only if still unknown
     st.subheader("Assign categories for remaining unknown merchants")
@@ -67,12 +122,9 @@ if uploaded is not None:
         unk_df = df.loc[unknown_mask, ["merchant"]].drop_duplicates().reset_index(drop=True)
         for i, row in unk_df.iterrows():
             with st.expander(f"{row['merchant']}"):
-                guess = web.guess(row["merchant"]) if enable_online else None
+                # Online lookup already returned nothing for these, so no suggestion to preselect
                 options = DEFAULT_CATEGORIES + ["Other"]
-                preselect = options.index(guess) if guess in options else 0
-                new_cat = st.selectbox("Choose a category", options, index=preselect, key=f"sel_{i}")
-                if guess:
-                    st.caption(f"Suggested by online lookup: **{guess}**")
+                new_cat = st.selectbox("Choose a category", options, index=0, key=f"sel_{i}")
                 if st.button("Save mapping", key=f"save_{i}"):
                     cat.learn(row["merchant"], new_cat)
                     st.success(f"Saved: {row['merchant']} → {new_cat}")
@@ -85,16 +137,14 @@ if uploaded is not None:
     df["your_share"] = df["amount"]
     edited = st.data_editor(
         df[["date", "merchant", "category", "amount", "is_shared", "your_share"]],
-        column_config={
-            "date": st.column_config.DateColumn("Date"),
-            "amount": st.column_config.NumberColumn("Amount", help="Positive = spend; negative = refund"),
-            "is_shared": st.column_config.CheckboxColumn("Shared?"),
-            "your_share": st.column_config.NumberColumn("Your share", help="Portion that applies to you"),
-        },
+        column_config=COLUMN_CONFIG,
         hide_index=True,
         num_rows="dynamic",
     )
-    edited["your_share"] = pd.to_numeric(edited["your_share"], errors="coerce").fillna(0.0)
+    share = edited["your_share"]
+    if not pd.api.types.is_numeric_dtype(share):
+        share = pd.to_numeric(share, errors="coerce")
+    edited["your_share"] = share.fillna(0.0)
 
     # Totals + chart
     total_spend = edited["amount"].sum()
@@ -106,15 +156,18 @@ if uploaded is not None:
         st.metric("Your total (sum of Your share)", f"{total_yours:,.2f}")
 
     st.divider()
-    edited["category"] = edited["category"].fillna("Uncategorized")
-    by_cat = edited.groupby("category", as_index=False)["your_share"].sum().sort_values("your_share", ascending=False)
+    category = edited["category"].fillna("Uncategorized")
+    # Keep any custom categories from the saved map or edits alongside the defaults
+    vocab = list(dict.fromkeys(DEFAULT_CATEGORIES + ["Uncategorized"] + category.unique().tolist()))
+    edited["category"] = category.astype(pd.CategoricalDtype(categories=vocab))
+    by_cat, fig = build_by_cat_and_fig(edited[["category", "your_share"]])
     st.subheader("Spend by category (your share)")
     st.dataframe(by_cat, use_container_width=True)
-    fig = px.pie(by_cat, names="category", values="your_share", title="Your share by category")
     st.plotly_chart(fig, use_container_width=True)
 
     # Download
     st.subheader("Download results")
-    out = edited.copy()
-    out["date"] = out["date"].dt.strftime("%Y-%m-%d")
-    st.download_button("Download categorized CSV", data=out.to_csv(index=False), file_name="categorized_statement.csv", mime="text/csv")
+    out = edited.assign(date=edited["date"].dt.strftime("%Y-%m-%d"))
+    buf = io.BytesIO()
+    out.to_csv(buf, index=False)
+    st.download_button("Download categorized CSV", data=buf.getvalue(), file_name="categorized_statement.csv", mime="text/csv")
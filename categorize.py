@@ -1,10 +1,11 @@
 from __future__ import annotations
+import csv
 import re
 import time
+import threading
 import requests
-import wikipedia
 import pandas as pd
-from fuzzywuzzy import fuzz, process
+from rapidfuzz import fuzz, process, utils
 from pathlib import Path
 
 MAP_PATH = Path("data/merchant_map.csv")
@@ -28,6 +29,17 @@ KEYWORDS_TO_CATEGORY = [
     (re.compile(r"\b(amazon|target|walmart|costco|mall|boutique|store|retail|shop|outlet)\b", re.I), "Shopping"),
 ]
 
+# All keyword hints fused into one alternation so a text is scanned once
+_KEYWORDS_RE = re.compile(
+    "|".join(f"(?P<k{i}>{pat.pattern})" for i, (pat, _) in enumerate(KEYWORDS_TO_CATEGORY)),
+    re.I,
+)
+
+def _keyword_category(text: str) -> str | None:
+    # List order is the priority (Shopping is the catch-all), not position in the text
+    hits = {int(m.lastgroup[1:]) for m in _KEYWORDS_RE.finditer(text)}
+    return KEYWORDS_TO_CATEGORY[min(hits)][1] if hits else None
+
 class MerchantCategorizer:
     """Local merchant→category memory with fuzzy lookup."""
     def __init__(self, map_path: Path = MAP_PATH):
@@ -37,91 +49,161 @@ class MerchantCategorizer:
     def _load_map(self):
         self.map_path.parent.mkdir(parents=True, exist_ok=True)
         if self.map_path.exists():
-            self.map_df = pd.read_csv(self.map_path)
+            map_df = pd.read_csv(self.map_path)
         else:
-            self.map_df = pd.DataFrame(columns=["merchant", "category"])
-            self.map_df.to_csv(self.map_path, index=False)
+            map_df = pd.DataFrame(columns=["merchant", "category"])
+            map_df.to_csv(self.map_path, index=False)
 
-        if len(self.map_df):
-            self.map_df["merchant_norm"] = self.map_df["merchant"].astype(str).str.upper().str.strip()
-        else:
-            self.map_df["merchant_norm"] = []
+        merchant_norm = map_df["merchant"].astype(str).str.upper().str.strip()
+        self._norm_to_cat: dict[str, str] = dict(zip(merchant_norm, map_df["category"]))
+        self._norm_to_raw: dict[str, str] = dict(zip(merchant_norm, map_df["merchant"]))
+        self._norms = list(self._norm_to_cat)
+        self._choices_processed = [utils.default_process(m) for m in self._norms]
 
     def save(self):
-        out = self.map_df[["merchant", "category"]].copy()
-        out.to_csv(self.map_path, index=False)
+        with open(self.map_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["merchant", "category"])
+            writer.writerows((self._norm_to_raw[n], c) for n, c in self._norm_to_cat.items())
 
-    def _best_match(self, desc: str, threshold: int = 85) -> tuple[str | None, int]:
-        if not len(self.map_df):
+    def _best_match(self, norm: str, threshold: int = 85) -> tuple[str | None, int]:
+        if not self._norms:
             return None, 0
-        choices = self.map_df["merchant_norm"].tolist()
-        match, score = process.extractOne(desc.upper().strip(), choices, scorer=fuzz.token_set_ratio)
-        return (match, score) if score >= threshold else (None, score)
+        query = utils.default_process(norm)
+        res = process.extractOne(query, self._choices_processed, scorer=fuzz.token_set_ratio,
+                                 processor=None, score_cutoff=threshold)
+        if res is None:
+            return None, 0
+        _, score, idx = res
+        return self._norms[idx], score
 
     def get_category(self, description: str) -> str | None:
-        match, score = self._best_match(description)
-        if match is None:
-            return None
-        row = self.map_df.loc[self.map_df["merchant_norm"] == match].iloc[0]
-        return row["category"]
+        return self.get_category_norm(str(description).upper().strip())
+
+    def get_category_norm(self, norm: str) -> str | None:
+        """Like get_category, for a description that is already uppercased and stripped."""
+        if norm in self._norm_to_cat:
+            return self._norm_to_cat[norm]
+        match, score = self._best_match(norm)
+        return self._norm_to_cat.get(match)
+
+    def categorize_many(self, norms: list[str], threshold: int = 85) -> list[str | None]:
+        """Score already-normalized merchants against the saved map in one batched pass."""
+        if not self._norms or not norms:
+            return [None] * len(norms)
+        out = [self._norm_to_cat.get(n) for n in norms]
+        # Only merchants without an exact hit go through the fuzzy scorer
+        fuzzy = [i for i, n in enumerate(norms) if n not in self._norm_to_cat]
+        if not fuzzy:
+            return out
+        queries = [utils.default_process(norms[i]) for i in fuzzy]
+        scores = process.cdist(queries, self._choices_processed, scorer=fuzz.token_set_ratio,
+                               processor=None, score_cutoff=threshold, workers=-1)
+        best = scores.argmax(axis=1)
+        for row, (i, j) in enumerate(zip(fuzzy, best)):
+            if scores[row, j] >= threshold:
+                out[i] = self._norm_to_cat[self._norms[j]]
+        return out
 
     def learn(self, merchant_raw: str, category: str):
         merchant_norm = str(merchant_raw).upper().strip()
-        exists = self.map_df["merchant_norm"] == merchant_norm
-        if exists.any():
-            self.map_df.loc[exists, "category"] = category
-        else:
-            self.map_df = pd.concat([
-                self.map_df,
-                pd.DataFrame({"merchant": [merchant_raw], "category": [category], "merchant_norm": [merchant_norm]}),
-            ], ignore_index=True)
-        self.save()
+        if merchant_norm in self._norm_to_cat:
+            # Updating an existing mapping needs a full rewrite
+            self._norm_to_cat[merchant_norm] = category
+            self.save()
+            return
+        self._norm_to_cat[merchant_norm] = category
+        self._norm_to_raw[merchant_norm] = merchant_raw
+        self._norms.append(merchant_norm)
+        self._choices_processed.append(utils.default_process(merchant_norm))
+        # The map file may be hand-edited; don't glue the new row onto an unterminated last line
+        with open(self.map_path, "rb") as f:
+            size = f.seek(0, 2)
+            if size:
+                f.seek(-1, 2)
+            needs_newline = size > 0 and f.read(1) not in (b"\n", b"\r")
+        with open(self.map_path, "a", newline="", encoding="utf-8") as f:
+            if needs_newline:
+                f.write("\n")
+            csv.writer(f, lineterminator="\n").writerow([merchant_raw, category])
 
 class OnlineGuesser:
     """Best-effort online hints: OpenStreetMap + Wikipedia keyword scan."""
-    def __init__(self, timeout=6):
+    def __init__(self, timeout=6, min_interval=1.0, wiki_min_interval=0.1):
         self.timeout = timeout
+        # Minimum spacing between requests per host; Nominatim usage policy is max 1 request/second
+        self._intervals = {"osm": min_interval, "wikipedia": wiki_min_interval}
+        self._next_request = {host: 0.0 for host in self._intervals}
+        self._lock = threading.Lock()
         self.session = requests.Session()
         self.session.headers.update({
             "User-Agent": "SpendWise/1.0 (educational; contact: user@example.com)"
         })
+        self._cache: dict[str, str | None] = {}
+
+    def _throttle(self, host: str):
+        """Block until the next request slot for host; safe to call from worker threads."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request[host] - now
+            self._next_request[host] = max(now, self._next_request[host]) + self._intervals[host]
+        if wait > 0:
+            time.sleep(wait)
 
+    # The _from_* helpers return None for "no match" and raise when the lookup itself failed
     def _from_osm(self, name: str) -> str | None:
-        try:
-            url = "https://nominatim.openstreetmap.org/search"
-            params = {"q": name, "format": "json", "limit": 1}
-            r = self.session.get(url, params=params, timeout=self.timeout)
-            if r.status_code != 200:
-                return None
-            items = r.json()
-            if not items:
-                return None
-            display = (items[0].get("display_name") or "")
-            clazz = items[0].get("class") or ""
-            typ = items[0].get("type") or ""
-            hint = f"{display} {clazz} {typ}"
-            for pat, cat in KEYWORDS_TO_CATEGORY:
-                if pat.search(hint):
-                    return cat
-        except Exception:
+        self._throttle("osm")
+        url = "https://nominatim.openstreetmap.org/search"
+        params = {"q": name, "format": "json", "limit": 1}
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        items = r.json()
+        if not items:
             return None
-        return None
+        display = (items[0].get("display_name") or "")
+        clazz = items[0].get("class") or ""
+        typ = items[0].get("type") or ""
+        hint = f"{display} {clazz} {typ}"
+        return _keyword_category(hint)
 
     def _from_wikipedia(self, name: str) -> str | None:
-        try:
-            wikipedia.set_rate_limiting(True)
-            results = wikipedia.search(name, results=1)
-            if not results:
-                return None
-            page = wikipedia.page(results[0], auto_suggest=False)
-            text = (page.summary or "")[:1000]
-            for pat, cat in KEYWORDS_TO_CATEGORY:
-                if pat.search(text):
-                    return cat
-        except Exception:
+        url = "https://en.wikipedia.org/w/api.php"
+        params = {"action": "query", "list": "search", "srsearch": name, "srlimit": 1, "format": "json"}
+        self._throttle("wikipedia")
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        results = r.json().get("query", {}).get("search") or []
+        if not results:
             return None
-        return None
+        title = requests.utils.quote(results[0]["title"].replace(" ", "_"), safe="")
+        self._throttle("wikipedia")
+        r = self.session.get(f"https://en.wikipedia.org/api/rest_v1/page/summary/{title}", timeout=self.timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        page = r.json()
+        if page.get("type") == "disambiguation":
+            return None
+        text = (page.get("extract") or "")[:1000]
+        return _keyword_category(text)
+
+    def is_cached(self, name: str) -> bool:
+        return str(name).upper().strip() in self._cache
 
     def guess(self, name: str) -> str | None:
-        time.sleep(0.2)  # be polite to external services
-        return self._from_osm(name) or self._from_wikipedia(name)
+        key = str(name).upper().strip()
+        if key in self._cache:
+            return self._cache[key]
+        res, failed = None, False
+        for lookup in (self._from_osm, self._from_wikipedia):
+            try:
+                res = lookup(name)
+            except Exception:
+                failed = True  # timeout, HTTP error, rate limit, bad JSON...
+                continue
+            if res:
+                break
+        # Don't let a transient outage pin "no guess" on a merchant for the process lifetime
+        if res is not None or not failed:
+            self._cache[key] = res
+        return res